@@ -1,5 +1,10 @@
+import asyncio
+import numpy as np
 import pandas as pd
-import requests
+import httpx
+import orjson
+import re
+import sqlite3
 import time
 import random
 from typing import Tuple, Optional
@@ -9,233 +14,475 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+API_NAMES = {0: "Postcodes.io", 1: "Nominatim"}
+
+# Starting and maximum number of in-flight requests per API (0 = postcodes.io,
+# 1 = Nominatim). The limit adapts between 1 and the maximum as the API responds.
+API_CONCURRENCY = {0: 8, 1: 1}
+API_MAX_CONCURRENCY = {0: 32, 1: 1}
+
+# Minimum seconds between the start of consecutive requests to each API
+API_INTERVAL = {0: 0.05, 1: 1.0}
+
+# Shape of a normalised UK postcode, e.g. "SW1A1AA" or "M11AE"
+UK_POSTCODE_PATTERN = re.compile(r'^[A-Z]{1,2}\d[A-Z\d]?\d[A-Z]{2}$')
+
+# postcodes.io accepts at most 100 postcodes per bulk lookup
+POSTCODES_IO_BATCH_SIZE = 100
+
+# Rows written per chunk when streaming CSV output
+OUTPUT_CHUNK_SIZE = 10_000
+
+# Read input columns back verbatim when they're copied through to the output
+PASSTHROUGH_READ_OPTIONS = {'dtype': str, 'keep_default_na': False}
+
+# Transient errors are retried with exponential backoff before counting as a failure
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+
+# After this many consecutive failures an API is paused for BREAKER_COOLDOWN
+# seconds. Requests are let through again once it ends, but the first further
+# failure re-opens the breaker straight away until a request succeeds.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+
+# Successful lookups are kept here so repeat runs don't hit the APIs again
+CACHE_FILE = "geocode_cache.sqlite"
+
+class AdaptiveLimiter:
+    """Async concurrency limit tuned by additive-increase/multiplicative-decrease.
+
+    The limit grows by one after a full window of successful requests and halves
+    when the API throttles us or errors, so it settles just below the point where
+    the server starts pushing back. A burst of throttled responses to requests
+    that were all in flight together counts as one congestion event, so the
+    limit halves once rather than collapsing to 1.
+    """
+    
+    def __init__(self, initial: int, maximum: int):
+        self.limit = initial
+        self.maximum = maximum
+        self._in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+    
+    def record_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+    
+    def record_throttle(self, started: float):
+        """Halve the limit, unless the request was sent before the last decrease"""
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        if self.limit > 1:
+            self.limit //= 2
+            logger.info("Throttled - reducing concurrency to %d", self.limit)
+        self._successes = 0
+
 class MultiAPIGeocoder:
-    def __init__(self):
-        self.current_api = 0
-        self.request_counts = {}
+    def __init__(self, cache_file: str = CACHE_FILE):
+        self.resolved_counts = {}
         self.failure_counts = {}
-        self.api_disabled = {}
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': 'PostcodeGeocoder/1.0'})
+        self._open_until = {}
+        self.limiters = {}
+        self._next_allowed = {}
+        self.session: Optional[httpx.AsyncClient] = None
         
         # Initialize counters
         for i in range(2):
-            self.request_counts[i] = 0
+            self.resolved_counts[i] = 0
             self.failure_counts[i] = 0
-            self.api_disabled[i] = False
+            self._open_until[i] = 0.0
+            self.limiters[i] = AdaptiveLimiter(API_CONCURRENCY[i], API_MAX_CONCURRENCY[i])
+            self._next_allowed[i] = 0.0
+        
+        # In-memory cache backed by sqlite, keyed by normalised postcode
+        # (upper case, no spaces, e.g. "SW1A1AA")
+        self._cache: dict[str, Optional[Tuple[float, float]]] = {}
+        self._db = sqlite3.connect(cache_file)
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache (postcode TEXT PRIMARY KEY, lat REAL, lon REAL)")
+        self.cache_hits = 0
+    
+    def load_cache(self, postcodes: list[str]):
+        """Pull any previously geocoded postcodes from disk into memory"""
+        keys = list(set(postcodes))
+        
+        # Stay under sqlite's limit on bound parameters per query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            query = f"SELECT postcode, lat, lon FROM cache WHERE postcode IN ({placeholders})"
+            for postcode, lat, lon in self._db.execute(query, chunk):
+                self._cache[postcode] = (lat, lon)
+        
+        logger.info("Loaded %d cached postcodes from disk", len(self._cache))
+    
+    def get_cached(self, postcode: str) -> Optional[Tuple[float, float]]:
+        """Return cached coordinates for a postcode, or None if it hasn't been geocoded yet"""
+        coords = self._cache.get(postcode)
+        if coords:
+            self.cache_hits += 1
+        return coords
+    
+    def store_cached(self, postcode: str, coords: Tuple[float, float]):
+        """Write a successful lookup through to memory and disk"""
+        self._cache[postcode] = coords
+        self._db.execute("INSERT OR REPLACE INTO cache (postcode, lat, lon) VALUES (?, ?, ?)", (postcode, coords[0], coords[1]))
+    
+    def save_cache(self):
+        self._db.commit()
+    
+    async def __aenter__(self):
+        # HTTP/2 lets concurrent postcodes.io requests share one connection;
+        # Nominatim negotiates down to HTTP/1.1 transparently
+        self.session = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30),
+            headers={'User-Agent': 'PostcodeGeocoder/1.0'},
+            timeout=10
+        )
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.aclose()
+        self.save_cache()
+        self._db.close()
+    
+    def api_available(self, api: int) -> bool:
+        """Whether the circuit breaker currently lets requests through to an API"""
+        return time.monotonic() >= self._open_until[api]
+    
+    async def wait_until_available(self, api: int):
+        """Sleep out an open circuit breaker rather than skipping requests"""
+        wait = self._open_until[api] - time.monotonic()
+        if wait > 0:
+            logger.info("%s is paused - waiting %.0fs before trying again", API_NAMES[api], wait)
+            await asyncio.sleep(wait)
+    
+    def _record_success(self, api: int):
+        self.failure_counts[api] = 0
+        self._open_until[api] = 0.0
+    
+    def _record_failure(self, api: int):
+        self.failure_counts[api] += 1
+        
+        # Once tripped, any failure after the cooldown re-opens the breaker
+        if self.failure_counts[api] >= BREAKER_THRESHOLD:
+            logger.warning("%s has failed %d times consecutively - pausing it for %ds",
+                           API_NAMES[api], self.failure_counts[api], BREAKER_COOLDOWN)
+            self._open_until[api] = time.monotonic() + BREAKER_COOLDOWN
+    
+    async def _wait_for_slot(self, api: int):
+        """Wait until the given API may be called again, then book the next slot"""
+        now = time.monotonic()
+        wait = self._next_allowed[api] - now
+        
+        # Book the slot before sleeping so concurrent callers queue up behind it
+        self._next_allowed[api] = max(now, self._next_allowed[api]) + API_INTERVAL[api]
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    async def _fetch_json(self, api: int, method: str, url: str, **kwargs):
+        """Send a request and decode the JSON body, retrying transient errors"""
+        limiter = self.limiters[api]
+        for attempt in range(MAX_RETRIES + 1):
+            delay = RETRY_BACKOFF * 2 ** attempt
+            
+            # Every attempt, retries included, takes its own slot so the API's
+            # rate limit holds even when backoff is shorter than the interval
+            await self._wait_for_slot(api)
+            started = time.monotonic()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    # A 404 is an unknown postcode, not a sign the API is struggling
+                    if response.is_success or response.status_code == 404:
+                        limiter.record_success()
+                    response.raise_for_status()
+                    return orjson.loads(response.content)
+                
+                limiter.record_throttle(started)
+                if attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                
+                # Honour the server's own idea of when to come back, if it gives one
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+            except httpx.TransportError:
+                limiter.record_throttle(started)
+                if attempt == MAX_RETRIES:
+                    raise
+            
+            await asyncio.sleep(delay)
     
-    def geocode_nominatim(self, postcode: str) -> Optional[Tuple[float, float]]:
+    async def geocode_nominatim(self, postcode: str) -> Optional[Tuple[float, float]]:
         """Geocode using OpenStreetMap Nominatim (1 req/sec limit)"""
         try:
             url = "https://nominatim.openstreetmap.org/search"
             params = {
-                'q': postcode,
+                'q': f"{postcode[:-3]} {postcode[-3:]}",  # Nominatim matches best with the space restored
                 'format': 'json',
-                'limit': 1,
+                'limit': '1',
                 'countrycodes': 'gb'  # Assuming UK postcodes, change as needed
             }
             
-            response = self.session.get(url, params=params, timeout=10)
-            response.raise_for_status()
+            async with self.limiters[1]:
+                data = await self._fetch_json(1, 'GET', url, params=params)
             
-            data = response.json()
+            self._record_success(1)
             if data:
-                # Reset failure count on success
-                self.failure_counts[1] = 0
+                self.resolved_counts[1] += 1
                 return float(data[0]['lat']), float(data[0]['lon'])
             return None
             
         except Exception as e:
-            self.failure_counts[1] += 1
-            
-            # If 5 consecutive failures, temporarily disable this API
-            if self.failure_counts[1] >= 5:
-                logger.warning(f"Nominatim has failed 5 times consecutively - temporarily disabling")
-                self.api_disabled[1] = True
-            
-            logger.warning(f"Nominatim failed for {postcode}: {e}")
+            self._record_failure(1)
+            logger.warning("Nominatim failed for %s: %s", postcode, e)
             return None
     
-    def geocode_postcodes_io(self, postcode: str) -> Optional[Tuple[float, float]]:
-        """Geocode using postcodes.io (UK specific, 1000 req/day limit)"""
+    async def geocode_postcodes_io_bulk(self, postcodes: list[str]) -> Optional[list[Optional[Tuple[float, float]]]]:
+        """Geocode up to 100 postcodes in one request using the postcodes.io bulk endpoint
+
+        Returns None if the request itself failed, as opposed to a list with None
+        for each postcode that postcodes.io didn't recognise.
+        """
         try:
-            url = f"https://api.postcodes.io/postcodes/{postcode.replace(' ', '')}"
+            url = "https://api.postcodes.io/postcodes"
+            payload = {'postcodes': postcodes}
             
-            response = self.session.get(url, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
-            if data.get('status') == 200:
-                result = data['result']
-                # Reset failure count on success
-                self.failure_counts[0] = 0
-                return float(result['latitude']), float(result['longitude'])
-            return None
+            async with self.limiters[0]:
+                # Batches queue on the limiter long before any of them fail, so the
+                # breaker has to be checked once a slot is actually ours. A short
+                # outage is waited out rather than pushing the batch onto Nominatim.
+                await self.wait_until_available(0)
+                data = await self._fetch_json(
+                    0, 'POST', url, content=orjson.dumps(payload), headers={'Content-Type': 'application/json'}
+                )
             
-        except Exception as e:
-            self.failure_counts[0] += 1
+            # Results come back in the same order as the submitted postcodes
+            results = []
+            for item in data['result']:
+                result = item.get('result')
+                if result and result.get('latitude') is not None:
+                    results.append((float(result['latitude']), float(result['longitude'])))
+                else:
+                    results.append(None)
             
-            # If 5 consecutive failures, temporarily disable this API
-            if self.failure_counts[0] >= 5:
-                logger.warning(f"Postcodes.io has failed 5 times consecutively - temporarily disabling")
-                self.api_disabled[0] = True
+            self._record_success(0)
+            self.resolved_counts[0] += sum(coords is not None for coords in results)
+            return results
             
-            logger.warning(f"Postcodes.io failed for {postcode}: {e}")
+        except Exception as e:
+            self._record_failure(0)
+            logger.warning("Postcodes.io bulk lookup failed for %d postcodes: %s", len(postcodes), e)
             return None
     
-
-    
-    def geocode_postcode(self, postcode: str) -> Optional[Tuple[float, float]]:
-        """Alternate between Nominatim and postcodes.io with smart fallback"""
-        
-        # If both APIs are disabled, try to re-enable them
-        if self.api_disabled[0] and self.api_disabled[1]:
-            logger.info("Both APIs disabled - re-enabling and resetting failure counts")
-            self.api_disabled[0] = False
-            self.api_disabled[1] = False
-            self.failure_counts[0] = 0
-            self.failure_counts[1] = 0
-        
-        # Determine which API to try first
-        primary_api = self.current_api
-        fallback_api = 1 - self.current_api
-        
-        # Skip disabled APIs
-        if self.api_disabled[primary_api]:
-            primary_api, fallback_api = fallback_api, primary_api
-        
-        # Try primary API
-        if not self.api_disabled[primary_api]:
-            if primary_api == 0:  # Postcodes.io
-                logger.info(f"Trying postcodes.io for {postcode}")
-                coords = self.geocode_postcodes_io(postcode)
-                if coords:
-                    self.request_counts[0] += 1
-                    logger.info(f"✓ Postcodes.io success for {postcode}")
-                    self.current_api = 1  # Switch to Nominatim next
-                    time.sleep(0.1)
-                    return coords
-                    
-            else:  # Nominatim
-                logger.info(f"Trying Nominatim for {postcode}")
-                coords = self.geocode_nominatim(postcode)
-                if coords:
-                    self.request_counts[1] += 1
-                    logger.info(f"✓ Nominatim success for {postcode}")
-                    self.current_api = 0  # Switch to postcodes.io next
-                    time.sleep(0.7)
-                    return coords
-        
-        # Try fallback API if primary failed
-        if not self.api_disabled[fallback_api]:
-            logger.info(f"Primary API failed, trying fallback for {postcode}")
-            
-            if fallback_api == 0:  # Postcodes.io
-                coords = self.geocode_postcodes_io(postcode)
-                if coords:
-                    self.request_counts[0] += 1
-                    logger.info(f"✓ Postcodes.io fallback success for {postcode}")
-                    self.current_api = 1
-                    time.sleep(0.1)
-                    return coords
-                    
-            else:  # Nominatim
-                # Need to respect rate limit for Nominatim
-                time.sleep(0.7)
-                coords = self.geocode_nominatim(postcode)
-                if coords:
-                    self.request_counts[1] += 1
-                    logger.info(f"✓ Nominatim fallback success for {postcode}")
-                    self.current_api = 0
-                    time.sleep(0.4)  # Additional delay since we already waited
-                    return coords
-        
-        # Switch API for next request even if both failed
-        self.current_api = 1 - self.current_api
-        
-        logger.error(f"All available APIs failed for postcode: {postcode}")
-        return None
-
 def process_postcodes(input_file: str, output_file: str, postcode_column: str):
     """Process postcodes from CSV/Excel file"""
+    asyncio.run(process_postcodes_async(input_file, output_file, postcode_column))
+
+async def process_postcodes_async(input_file: str, output_file: str, postcode_column: str):
+    """Geocode all postcodes concurrently, then save the results"""
     
-    # Read the file
-    try:
+    def read_input(**kwargs) -> pd.DataFrame:
         if input_file.endswith('.csv'):
-            df = pd.read_csv(input_file)
-        else:
-            df = pd.read_excel(input_file)
-        logger.info(f"Loaded {len(df)} rows from {input_file}")
+            return pd.read_csv(input_file, **kwargs)
+        return pd.read_excel(input_file, **kwargs)
+    
+    # Read just the header first, then only the postcode column; the other
+    # columns are streamed back in when the output is written
+    try:
+        columns = list(read_input(nrows=0).columns)
+        
+        # Check if postcode column exists
+        if postcode_column not in columns:
+            logger.error("Column '%s' not found. Available columns: %s", postcode_column, columns)
+            return
+        
+        df = read_input(usecols=[postcode_column])
+        logger.info("Loaded %d rows from %s", len(df), input_file)
     except Exception as e:
-        logger.error(f"Error reading file: {e}")
+        logger.error("Error reading file: %s", e)
         return
     
-    # Check if postcode column exists
-    if postcode_column not in df.columns:
-        logger.error(f"Column '{postcode_column}' not found. Available columns: {list(df.columns)}")
-        return
+    total_rows = len(df)
+    completed = 0
     
-    # Initialize geocoder
-    geocoder = MultiAPIGeocoder()
+    # Normalise and validate every postcode in one vectorised pass so no
+    # requests are wasted on blanks or malformed values. The normalised form
+    # (upper case, no spaces) is what gets sent to the APIs and cached.
+    postcodes = df[postcode_column].astype('string').str.strip().str.upper().str.replace(' ', '', regex=False)
+    valid = postcodes.str.match(UK_POSTCODE_PATTERN, na=False)
+    logger.info("Skipping %d rows with empty or invalid postcodes", (~valid).sum())
     
-    # Add new columns for coordinates
-    df['latitude'] = None
-    df['longitude'] = None
-    df['geocoded'] = False
+    # Many rows share a postcode, so each distinct postcode is only geocoded once
+    unique_postcodes = postcodes[valid].drop_duplicates().tolist()
+    lookup: dict[str, Optional[Tuple[float, float]]] = {}
     
-    # Process each postcode
-    total_rows = len(df)
-    successful = 0
+    postcode_values = postcodes.to_numpy(dtype=object, na_value='')
     
-    for index, row in df.iterrows():
-        postcode = str(row[postcode_column]).strip()
+    def result_columns(values) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Fill plain numpy arrays for a run of rows so each column is assigned
+        # in one go, rather than writing every row back individually
+        lat = np.full(len(values), np.nan)
+        lon = np.full(len(values), np.nan)
+        ok = np.zeros(len(values), dtype=bool)
         
-        if pd.isna(postcode) or postcode == '' or postcode.lower() == 'nan':
-            logger.info(f"Skipping empty postcode at row {index + 1}")
-            continue
+        for i, postcode in enumerate(values):
+            coords = lookup.get(postcode)
+            if coords:
+                lat[i], lon[i] = coords
+                ok[i] = True
         
-        logger.info(f"Processing {index + 1}/{total_rows}: {postcode}")
-        
-        # Try to geocode
-        coords = geocoder.geocode_postcode(postcode)
+        return lat, lon, ok
+    
+    def record_result(postcode: str, coords: Optional[Tuple[float, float]]):
+        lookup[postcode] = coords
         
         if coords:
-            df.at[index, 'latitude'] = coords[0]
-            df.at[index, 'longitude'] = coords[1]
-            df.at[index, 'geocoded'] = True
-            successful += 1
-            logger.info(f"✓ {postcode} -> {coords[0]:.6f}, {coords[1]:.6f}")
+            geocoder.store_cached(postcode, coords)
+            logger.info("✓ %s -> %.6f, %.6f", postcode, coords[0], coords[1])
         else:
-            logger.warning(f"✗ Failed to geocode: {postcode}")
+            logger.warning("✗ Failed to geocode: %s", postcode)
+    
+    def save_progress():
+        # Committing the cache is the checkpoint: a rerun picks these up from sqlite
+        logger.info("Saving progress... (%d/%d postcodes looked up)", completed, len(to_fetch))
+        geocoder.save_cache()
+    
+    def record_batch_failed(batch: list[str]):
+        # Left out of the cache, so a rerun tries these against postcodes.io again
+        nonlocal completed
+        for postcode in batch:
+            record_result(postcode, None)
+        completed += len(batch)
+    
+    async def geocode_batch(batch: list[str]) -> list[str]:
+        """Record what postcodes.io resolved and return the postcodes it had no result for"""
+        nonlocal completed
+        
+        coords_list = await geocoder.geocode_postcodes_io_bulk(batch)
         
-        # Save progress every 50 rows
-        if (index + 1) % 50 == 0:
-            logger.info(f"Saving progress... ({successful}/{index + 1} successful)")
-            df.to_csv(f"{output_file}.temp", index=False)
+        # Only postcodes postcodes.io actually answered with no result are worth
+        # sending to Nominatim; a failed request says nothing about the postcodes
+        if coords_list is None:
+            record_batch_failed(batch)
+            save_progress()
+            return []
+        
+        misses = []
+        for postcode, coords in zip(batch, coords_list):
+            if coords:
+                record_result(postcode, coords)
+                completed += 1
+            else:
+                misses.append(postcode)
+        
+        save_progress()
+        return misses
+    
+    async with MultiAPIGeocoder() as geocoder:
+        # Anything geocoded on a previous (or interrupted) run costs no HTTP at all
+        geocoder.load_cache(unique_postcodes)
+        to_fetch = []
+        for postcode in unique_postcodes:
+            coords = geocoder.get_cached(postcode)
+            if coords:
+                lookup[postcode] = coords
+            else:
+                to_fetch.append(postcode)
+        
+        batches = [to_fetch[i:i + POSTCODES_IO_BATCH_SIZE] for i in range(0, len(to_fetch), POSTCODES_IO_BATCH_SIZE)]
+        logger.info("%d unique postcodes, %d cached, geocoding %d in %d batches",
+                    len(unique_postcodes), geocoder.cache_hits, len(to_fetch), len(batches))
+        
+        # Pass 1: every postcode goes through the postcodes.io bulk endpoint,
+        # with all batches in flight at once (bounded by the API limiter and
+        # paused while its circuit breaker is open)
+        results = await asyncio.gather(*(geocode_batch(batch) for batch in batches), return_exceptions=True)
+        misses = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.error("Unexpected error while geocoding: %s", result)
+                record_batch_failed(batch)
+            else:
+                misses.extend(result)
+        
+        # Pass 2: only the leftovers go to Nominatim, one per second, so its
+        # rate limit never holds up the bulk lookups
+        if misses:
+            logger.info("Postcodes.io couldn't resolve %d postcodes, trying Nominatim", len(misses))
+        for postcode in misses:
+            # The lookups run one at a time, so after a pause the next one is
+            # the only trial request
+            await geocoder.wait_until_available(1)
+            coords = await geocoder.geocode_nominatim(postcode)
+            record_result(postcode, coords)
+            completed += 1
+            
+            # Save progress every 50 rows
+            if completed % 50 == 0:
+                save_progress()
+        save_progress()
     
     # Save final results
+    successful = 0
     try:
         if output_file.endswith('.csv'):
-            df.to_csv(output_file, index=False)
+            # Re-read the full input a chunk at a time and stream it out with the
+            # coordinate columns attached, so the whole file is never in memory.
+            # The other columns are only copied through, so they're read as text;
+            # otherwise each chunk would infer its own dtypes and format them differently.
+            if input_file.endswith('.csv'):
+                chunks = pd.read_csv(input_file, chunksize=OUTPUT_CHUNK_SIZE, **PASSTHROUGH_READ_OPTIONS)
+            else:
+                chunks = [read_input(**PASSTHROUGH_READ_OPTIONS)]
+            
+            start = 0
+            for chunk in chunks:
+                end = start + len(chunk)
+                lat, lon, ok = result_columns(postcode_values[start:end])
+                chunk = chunk.assign(latitude=lat, longitude=lon, geocoded=ok)
+                chunk.to_csv(output_file, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+                successful += int(ok.sum())
+                start = end
         else:
-            df.to_excel(output_file, index=False)
-        logger.info(f"Results saved to {output_file}")
+            lat, lon, ok = result_columns(postcode_values)
+            read_input(**PASSTHROUGH_READ_OPTIONS).assign(latitude=lat, longitude=lon, geocoded=ok).to_excel(output_file, index=False)
+            successful = int(ok.sum())
+        logger.info("Results saved to %s", output_file)
     except Exception as e:
-        logger.error(f"Error saving file: {e}")
+        logger.error("Error saving file: %s", e)
         return
     
     # Print summary
-    logger.info(f"\nSUMMARY:")
-    logger.info(f"Total rows processed: {total_rows}")
-    logger.info(f"Successfully geocoded: {successful}")
-    logger.info(f"Failed: {total_rows - successful}")
-    logger.info(f"Success rate: {(successful/total_rows)*100:.1f}%")
+    logger.info("\nSUMMARY:")
+    logger.info("Total rows processed: %d", total_rows)
+    logger.info("Successfully geocoded: %d", successful)
+    logger.info("Failed: %d", total_rows - successful)
+    logger.info("Success rate: %.1f%%", (successful/total_rows)*100)
     
     # Print API usage
-    logger.info(f"\nAPI Usage:")
-    api_names = ["Postcodes.io", "Nominatim"]
-    for i, count in geocoder.request_counts.items():
-        logger.info(f"{api_names[i]}: {count} requests")
+    logger.info("\nAPI Usage:")
+    for i, count in geocoder.resolved_counts.items():
+        logger.info("%s: %d postcodes resolved", API_NAMES[i], count)
 
 if __name__ == "__main__":
     # Configuration